@@ -1,11 +1,24 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import xlsxwriter
+import bcrypt
 import re
+import csv
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 import hashlib
+import hmac
 import os
 
+# Copy-on-write: filtered frames and column selections share data until a
+# write, so no processor needs defensive .copy() calls after a mask. It is
+# always on from pandas 3, where setting the option is deprecated.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
 # -------------------------------------------------
 # PAGE CONFIG
 # -------------------------------------------------
@@ -233,7 +246,8 @@ def apply_theme():
     else:
         st.markdown(DARK_THEME_CSS, unsafe_allow_html=True)
 
-# Apply theme before building UI
+# Apply theme before building UI. Streamlit drops any element a rerun does
+# not emit again, so this runs every rerun, but only once per run.
 apply_theme()
 
 # -------------------------------------------------
@@ -253,9 +267,20 @@ PROTECTED_KEY = "BOI2025VIP"  # change this to your secret signup key
 # ==========================
 
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+    """bcrypt hash with its salt embedded; bcrypt only reads the first 72 bytes."""
+    return bcrypt.hashpw(password.encode("utf-8")[:72], bcrypt.gensalt(rounds=12)).decode("ascii")
+
 
+def verify_password(password: str, stored_hash: str) -> bool:
+    """Check against a bcrypt hash, or a legacy unsalted SHA-256 hex digest."""
+    stored_hash = str(stored_hash)
+    if stored_hash.startswith("$2"):
+        return bcrypt.checkpw(password.encode("utf-8")[:72], stored_hash.encode("ascii"))
+    legacy = hashlib.sha256(password.encode("utf-8")).hexdigest()
+    return hmac.compare_digest(legacy, stored_hash)
 
+
+@st.cache_data(ttl=60, show_spinner=False)
 def load_users():
     if not os.path.exists(USERS_DB_FILE):
         return pd.DataFrame(columns=["username", "password_hash", "expiry"])
@@ -266,8 +291,31 @@ def load_users():
     return df
 
 
+@st.cache_data(ttl=60, show_spinner=False)
+def users_index() -> dict:
+    """username → (password_hash, expiry), so a login is one dict lookup."""
+    df = load_users()
+    return dict(zip(df["username"], zip(df["password_hash"], df["expiry"])))
+
+
 def save_users(df: pd.DataFrame):
     df.to_csv(USERS_DB_FILE, index=False)
+    load_users.clear()
+    users_index.clear()
+
+
+def _users_file_layout():
+    """
+    (header, ends_with_newline) for USERS_DB_FILE, or None when the file is
+    missing or empty. Reads only the first line and the last byte.
+    """
+    if not os.path.exists(USERS_DB_FILE) or os.path.getsize(USERS_DB_FILE) == 0:
+        return None
+    with open(USERS_DB_FILE, "rb") as f:
+        first = f.readline().decode("utf-8")
+        f.seek(-1, os.SEEK_END)
+        ends_with_newline = f.read(1) == b"\n"
+    return next(csv.reader([first]), []), ends_with_newline
 
 
 def create_user(username: str, password: str):
@@ -278,28 +326,47 @@ def create_user(username: str, password: str):
     pwd_hash = hash_password(password)
     expiry_date = (datetime.utcnow() + timedelta(days=30)).date().isoformat()
 
-    new_row = pd.DataFrame([{
+    record = {
         "username": username,
         "password_hash": pwd_hash,
         "expiry": expiry_date
-    }])
-
-    df = pd.concat([df, new_row], ignore_index=True)
-    save_users(df)
+    }
+
+    # Append the one new row instead of rewriting the whole table. That is
+    # only safe when the file's header is exactly load_users()' columns and
+    # its last line is terminated; otherwise rewrite it as before.
+    columns = list(df.columns)
+    layout = _users_file_layout()
+    if layout is not None and layout != (columns, True):
+        save_users(pd.concat([df, pd.DataFrame([record])], ignore_index=True))
+        return True, f"Account created. Valid until {expiry_date}"
+
+    with open(USERS_DB_FILE, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, restval="", lineterminator="\n")
+        if layout is None:
+            writer.writeheader()
+        writer.writerow(record)
+    load_users.clear()
+    users_index.clear()
     return True, f"Account created. Valid until {expiry_date}"
 
 
 def check_login(username: str, password: str):
-    df = load_users()
-    row = df[df["username"] == username]
-    if row.empty:
+    entry = users_index().get(username)
+    if entry is None:
         return False, "User not found."
 
-    pwd_hash = hash_password(password)
-    if row.iloc[0]["password_hash"] != pwd_hash:
+    stored_hash, expiry_str = entry
+    if not verify_password(password, stored_hash):
         return False, "Incorrect password."
 
-    expiry_str = str(row.iloc[0]["expiry"])
+    # Upgrade legacy SHA-256 rows to bcrypt the first time they log in.
+    if not str(stored_hash).startswith("$2"):
+        df = load_users()
+        df.loc[df["username"] == username, "password_hash"] = hash_password(password)
+        save_users(df)
+
+    expiry_str = str(expiry_str)
     try:
         expiry = datetime.strptime(expiry_str, "%Y-%m-%d").date()
     except Exception:
@@ -369,6 +436,38 @@ def logout():
 # Helper: Row selection for combiner
 # =====================================================
 
+# Like the original split()-based parser, words after a first/last count are
+# ignored ("first 100 rows") and a negative count means "all but" that many.
+_SELECT_RE = re.compile(
+    r"\s*(?:(all)|first\s+(-?\d+)(?:\s.*)?|last\s+(-?\d+)(?:\s.*)?|(\d+)\s*-\s*(\d+))\s*",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+@lru_cache(maxsize=128)
+def _parse_choice(choice: str):
+    """
+    Turn a row-selection string into the positional slice it selects, or
+    None when the string is not a recognised selection.
+    """
+    m = _SELECT_RE.fullmatch(choice or "all")
+    if not m:
+        return None
+
+    _all, first, last, start, end = m.groups()
+
+    if first:
+        # head(n): slice(None, -2) drops the last two, like head(-2).
+        return slice(None, int(first))
+    if last:
+        # tail(n): slice(2, None) for "last -2" drops the first two, like tail(-2);
+        # slice(-0, None) would select everything, so "last 0" is spelled out.
+        return slice(-int(last), None) if int(last) else slice(0, 0)
+    if start:
+        return slice(max(int(start) - 1, 0), int(end))
+    return slice(None)
+
+
 def select_rows(df: pd.DataFrame, choice: str) -> pd.DataFrame:
     """
     Supported:
@@ -376,168 +475,190 @@ def select_rows(df: pd.DataFrame, choice: str) -> pd.DataFrame:
       - first 100
       - last 100
       - 34-134  (1-based inclusive range)
+    Anything else returns the frame unchanged.
     """
-    if not choice:
-        return df
+    slc = _parse_choice(choice)
+    return df if slc is None else df.iloc[slc]
 
-    choice = choice.strip().lower()
 
-    if choice == "all":
-        return df
+# =====================================================
+# Helper: Excel output
+# =====================================================
 
-    if choice.startswith("first"):
-        try:
-            n = int(choice.split()[1])
-            return df.head(n)
-        except Exception:
-            return df
+_XLSX_CHUNK_ROWS = 10_000
+_XLSX_MAX_ROWS = 1_048_576  # Excel's per-sheet limit, header row included
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
 
-    if choice.startswith("last"):
-        try:
-            n = int(choice.split()[1])
-            return df.tail(n)
-        except Exception:
-            return df
 
-    if "-" in choice:
-        try:
-            start, end = choice.split("-")
-            start = int(start)
-            end = int(end)
-            return df.iloc[start - 1:end]
-        except Exception:
-            return df
+def _cell_values(col: pd.Series) -> list:
+    """Python values of one column, with None for every missing cell."""
+    try:
+        # Arrow-backed, categorical and numeric columns convert without an
+        # object-dtype copy; from_pandas turns NaN/NaT into nulls.
+        return pa.array(col, from_pandas=True).to_pylist()
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed object columns (e.g. numeric and text IDs) have no Arrow type.
+        return col.astype(object).where(col.notna(), None).tolist()
 
-    return df
+
+def to_xlsx_bytes(df: pd.DataFrame) -> bytes:
+    """
+    Serialise a frame to xlsx with xlsxwriter in constant-memory mode, which
+    flushes each row to disk instead of holding the whole sheet in memory.
+
+    That mode only accepts rows in order, so this writes rows directly;
+    pandas' to_excel emits cells column by column and would lose data.
+    Cell values are pulled out of Arrow one block of rows at a time, so no
+    object-dtype copy of the whole frame is ever built.
+
+    Raises ValueError when the frame does not fit on one sheet; xlsxwriter
+    would otherwise drop every row past the limit without complaint.
+    """
+    if len(df) + 1 > _XLSX_MAX_ROWS:
+        raise ValueError(
+            f"{len(df):,} rows do not fit in one Excel sheet "
+            f"(max {_XLSX_MAX_ROWS - 1:,}); download CSV or Parquet instead."
+        )
+
+    out = BytesIO()
+    # Without a default date format xlsxwriter leaves datetimes as bare serial
+    # numbers; this matches the format pandas' to_excel used to write.
+    workbook = xlsxwriter.Workbook(out, {
+        "constant_memory": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    sheet = workbook.add_worksheet()
+
+    sheet.write_row(0, 0, list(df.columns))
+    for start in range(0, len(df), _XLSX_CHUNK_ROWS):
+        chunk = df.iloc[start:start + _XLSX_CHUNK_ROWS]
+        columns = [_cell_values(chunk.iloc[:, j]) for j in range(chunk.shape[1])]
+        for r, row in enumerate(zip(*columns), start=start + 1):
+            sheet.write_row(r, 0, row)
+
+    workbook.close()
+    return out.getvalue()
 
 
 # =====================================================
 # FLORIDA backend
 # =====================================================
 
+# Compiled once at import; _FL_LINE sweeps the whole decoded FL upload.
+#
+# Columns in the FL dump are separated by a run of 3+ whitespace characters
+# or by any shorter run containing a tab. A field is the text between two
+# separators with its surrounding whitespace trimmed, which _FL_FIELD matches
+# directly (non-blank, inner whitespace runs of at most two non-tab chars).
+# No class here matches \r or \n, so a match never runs past its own line.
+_FL_SEP = r"(?:[^\S\r\n]{3,}|\t\t|[^\S\t\r\n]?\t[^\S\t\r\n]?)"
+_FL_FIELD = r"\S+(?:[^\S\t\r\n]{1,2}\S+)*"
+
+# One match per entity line (a line may end in \n, \r\n or \r); lines with
+# fewer than the eight columns after the entity ID simply do not match.
+_FL_LINE = re.compile(
+    rf"(?:^|(?<=\r))(?P<entity_id>[A-Z]\d{{11}})(?:[^\S\t\r\n]{{0,2}}(?P<name>{_FL_FIELD}))?"
+    rf"{_FL_SEP}{_FL_FIELD}"
+    rf"{_FL_SEP}(?P<p_street>{_FL_FIELD}){_FL_SEP}(?P<p_city>{_FL_FIELD}){_FL_SEP}(?P<p_zip>{_FL_FIELD})"
+    rf"{_FL_SEP}(?P<m_street>{_FL_FIELD}){_FL_SEP}(?P<m_city>{_FL_FIELD}){_FL_SEP}(?P<m_statezip>{_FL_FIELD})"
+    rf"(?:{_FL_SEP}[^\r\n]*?(?P<date>\d{{8}}))?",
+    re.MULTILINE,
+)
+_FL_ZIP = re.compile(r"(\d{5})")
+_FL_STATEZIP = re.compile(r"([A-Z]{2})\s*(\d{5})")
+
+# The original line loop split on str.splitlines(), which also breaks on
+# these characters. Turning them into \n keeps them out of the in-line
+# whitespace classes above, so a form feed between two records cannot merge
+# them into one match. NULs become spaces, as that loop did per line.
+_FL_TRANSLATE = str.maketrans({
+    "\x00": " ",
+    **dict.fromkeys("\v\f\x1c\x1d\x1e\x85\u2028\u2029", "\n"),
+})
+
 def process_florida(file_bytes: bytes, exact_date_str: str, mailing_only: bool) -> pd.DataFrame:
     """Process Florida TXT.
        If mailing_only=True → standard format:
        Name | Address | City | State | Zipcode | Filing Date | Document Number
     """
 
-    def split_parts(line: str):
-        return [p for p in re.split(r"\s{3,}|\t+", line.rstrip("\n\r")) if p.strip()]
-
-    def parse_entity_and_name(first_part: str):
-        m = re.match(r"^([A-Z]\d{11})(.*)$", first_part.strip())
-        if not m:
-            return "", ""
-        return m.group(1).strip(), m.group(2).strip()
-
-    def extract_principal(parts):
-        if len(parts) < 5:
-            return "", "", ""
-        p_street = parts[2].strip()
-        p_city   = parts[3].strip().rstrip(",")
-        m_zip = re.search(r"(\d{5})", parts[4])
-        p_zip = m_zip.group(1) if m_zip else ""
-        return p_street, p_city, p_zip
-
-    def extract_mailing(parts):
-        if len(parts) < 8:
-            return "", "", "", ""
-        m_street = parts[5].strip()
-        m_city   = parts[6].strip().rstrip(",")
-        state_token = parts[7].strip()
-        m_statezip = re.search(r"([A-Z]{2})\s*(\d{5})", state_token)
-        if m_statezip:
-            m_state = m_statezip.group(1)
-            m_zip   = m_statezip.group(2)
-        else:
-            m_state, m_zip = "", ""
-        return m_street, m_city, m_state, m_zip
-
-    def extract_filing_date(parts):
-        for p in parts[8:]:
-            m = re.search(r"(\d{8})", p)
-            if m:
-                mm, dd, yyyy = m.group(1)[0:2], m.group(1)[2:4], m.group(1)[4:]
-                return f"{mm}/{dd}/{yyyy}"
-        return ""
-
-    text = file_bytes.decode("utf-8", errors="ignore")
-    rows = []
-
-    for raw in text.splitlines():
-        line = raw.replace("\x00", " ").rstrip("\n\r")
-        if not line.strip():
-            continue
-
-        if not re.match(r"^[A-Z]\d{11}", line):
-            continue
-
-        parts = split_parts(line)
-        if len(parts) < 8:
-            continue
-
-        entity_id, business_name = parse_entity_and_name(parts[0])
-        if not entity_id:
-            continue
-
-        p_street, p_city, p_zip = extract_principal(parts)
-        m_street, m_city, m_state, m_zip = extract_mailing(parts)
-        filing_date = extract_filing_date(parts)
-
-        rows.append([
-            entity_id, business_name, filing_date,
-            p_street, p_city, p_zip,
-            m_street, m_city, m_state, m_zip
-        ])
-
-    df = pd.DataFrame(rows, columns=[
-        "Entity ID", "Business Name", "Filing Date",
-        "Principal Street", "Principal City", "Principal ZIP",
-        "Mailing Street", "Mailing City", "Mailing State", "Mailing ZIP"
-    ])
-
-    df["Filing Date Parsed"] = pd.to_datetime(df["Filing Date"], format="%m/%d/%Y", errors="coerce")
+    # One finditer sweep over the decoded upload finds each entity line and
+    # pulls its fields in the same pass; only the match tuples reach Python.
+    text = file_bytes.decode("utf-8", errors="ignore").translate(_FL_TRANSLATE)
+    rows = pd.DataFrame.from_records(
+        (m.groups() for m in _FL_LINE.finditer(text)),
+        columns=list(_FL_LINE.groupindex),
+    )
 
+    # The raw date is the MMDDYYYY digit run, so filter on that before any
+    # other per-row work and only format the rows that survive.
     if exact_date_str:
         try:
-            exact_date = pd.to_datetime(exact_date_str, format="%m/%d/%Y")
-            df = df[df["Filing Date Parsed"] == exact_date]
-        except Exception:
+            exact_date = datetime.strptime(exact_date_str, "%m/%d/%Y")
+        except ValueError:
             pass
+        else:
+            rows = rows[rows["date"] == exact_date.strftime("%m%d%Y")]
 
-    df = df.drop(columns=["Filing Date Parsed"], errors="ignore")
+    digits = rows["date"]
+    name = rows["name"].fillna("")
+    filing_date = (digits.str[:2] + "/" + digits.str[2:4] + "/" + digits.str[4:]).fillna("")
+    m_city = rows["m_city"].str.rstrip(",")
+    mailing = rows["m_statezip"].str.extract(_FL_STATEZIP).fillna("")
 
+    # Build only the requested schema, already in its final column order;
+    # the principal address is never parsed for mailing-only output.
     if mailing_only:
-        mailing_df = df[[
-            "Business Name",
-            "Mailing Street",
-            "Mailing City",
-            "Mailing State",
-            "Mailing ZIP",
-            "Filing Date",
-            "Entity ID"
-        ]].copy()
-
-        mailing_df.columns = [
-            "Name",
-            "Address",
-            "City",
-            "State",
-            "Zipcode",
-            "Filing Date",
-            "Document Number"
-        ]
-        df = mailing_df
+        df = pd.DataFrame({
+            "Name": name,
+            "Address": rows["m_street"],
+            "City": m_city,
+            "State": mailing[0],
+            "Zipcode": mailing[1],
+            "Filing Date": filing_date,
+            "Document Number": rows["entity_id"],
+        })
     else:
-        df = df[[
-            "Entity ID", "Business Name", "Filing Date",
-            "Principal Street", "Principal City", "Principal ZIP",
-            "Mailing Street", "Mailing City", "Mailing State", "Mailing ZIP"
-        ]]
+        df = pd.DataFrame({
+            "Entity ID": rows["entity_id"],
+            "Business Name": name,
+            "Filing Date": filing_date,
+            "Principal Street": rows["p_street"],
+            "Principal City": rows["p_city"].str.rstrip(","),
+            "Principal ZIP": rows["p_zip"].str.extract(_FL_ZIP, expand=False).fillna(""),
+            "Mailing Street": rows["m_street"],
+            "Mailing City": m_city,
+            "Mailing State": mailing[0],
+            "Mailing ZIP": mailing[1],
+        })
+
+    # Every field is trimmed by now, so a blank cell is exactly "" (or NaN).
+    # One boolean mask keeps complete rows without rebuilding the frame.
+    df = df[(df.notna() & df.ne("")).all(axis=1)]
+
+    return df
 
-    df = df.replace(r"^\s*$", pd.NA, regex=True)
-    df = df.dropna(how="any")
 
+# =====================================================
+# Helper: CSV loading for state backends
+# =====================================================
+
+def read_state_csv(file, columns) -> pd.DataFrame:
+    """
+    Read only the named columns of a state CSV with the multi-threaded
+    PyArrow parser. Header names are matched after stripping whitespace,
+    and the returned frame uses the stripped names.
+
+    Every column comes back as an Arrow string: the backends treat all
+    fields as text, and this keeps IDs/ZIPs verbatim and stops all-blank
+    columns from being inferred as the null type.
+    """
+    header = pd.read_csv(file, nrows=0).columns
+    file.seek(0)
+
+    usecols = [c for c in header if c.strip() in columns]
+    df = pd.read_csv(file, engine="pyarrow", dtype=pd.ArrowDtype(pa.string()), usecols=usecols)
+    df.columns = df.columns.str.strip()
     return df
 
 
@@ -545,61 +666,55 @@ def process_florida(file_bytes: bytes, exact_date_str: str, mailing_only: bool)
 # WASHINGTON backend
 # =====================================================
 
+# "street, city, state, zip..." — empty comma pieces are skipped and each
+# piece comes back trimmed; the ZIP is the first 5-digit run of the 4th piece.
+# Kept as a plain string: the Arrow-backed columns hand it to pyarrow's regex
+# engine, which takes pattern text rather than a compiled object.
+#
+# RE2's \s is ASCII-only, so _WA_SPACE spells out every character str.strip()
+# removes (NBSP, \v, the Unicode spaces, ...) to trim pieces the same way.
+_WA_SPACE = (
+    "\\s\v\x1c-\x1f\x85\xa0\u1680\u2000-\u200a"
+    "\u2028\u2029\u202f\u205f\u3000"
+)
+_WA_ADDRESS = (
+    rf"^[{_WA_SPACE},]*(?P<Address>[^,]*[^{_WA_SPACE},])[{_WA_SPACE}]*,"
+    rf"[{_WA_SPACE},]*(?P<City>[^,]*[^{_WA_SPACE},])[{_WA_SPACE}]*,"
+    rf"[{_WA_SPACE},]*(?P<State>[^,]*[^{_WA_SPACE},])[{_WA_SPACE}]*,"
+    rf"[{_WA_SPACE},]*[^,]*?(?P<Zipcode>\d{{5}})"
+)
+
 def process_washington_streamlit(file, added_date: str) -> pd.DataFrame:
     """
     Washington CSV → standard format:
     Name | Address | City | State | Zipcode | Filing Date | Document Number
     """
 
-    def split_address(addr: str):
-        if pd.isna(addr):
-            return pd.Series(["", "", "", ""])
-        addr_str = str(addr).strip()
-        parts = [p.strip() for p in addr_str.split(",") if p.strip()]
-
-        street = parts[0] if len(parts) > 0 else ""
-        city   = parts[1] if len(parts) > 1 else ""
-        state  = parts[2] if len(parts) > 2 else ""
-
-        zip_raw = parts[3] if len(parts) > 3 else ""
-        m = re.search(r"\d{5}", zip_raw)
-        zipcode = m.group(0) if m else ""
-
-        return pd.Series([street, city, state, zipcode])
-
-    data = pd.read_csv(file)
-    data.columns = data.columns.str.strip()
-    data["Filing Date"] = added_date
+    data = read_state_csv(file, [
+        "UBI#", "Business Name", "Status",
+        "Business Type", "Principal Office Address"
+    ])
 
     filtered = data[
         (data["Status"] == "Active") &
         (data["Principal Office Address"].notna()) &
         (data["Business Type"].str.strip().str.upper() == "WA LIMITED LIABILITY COMPANY")
-    ].copy()
-
-    addr_df = filtered["Principal Office Address"].apply(split_address)
-    addr_df.columns = ["Address", "City", "State", "Zipcode"]
-
-    filtered = pd.concat([filtered, addr_df], axis=1)
-
-    drop_cols = [
-        "Nonprofit EIN", "Status",
-        "Registered Agent Name", "Business Type",
-        "Principal Office Address"
     ]
-    filtered = filtered.drop(columns=drop_cols, errors="ignore")
 
-    final = pd.DataFrame()
-    final["Name"] = filtered["Business Name"].astype(str).str.strip()
-    final["Address"] = filtered["Address"].astype(str).str.strip()
-    final["City"] = filtered["City"].astype(str).str.strip()
-    final["State"] = filtered["State"].astype(str).str.strip()
-    final["Zipcode"] = filtered["Zipcode"].astype(str).str.strip()
-    final["Filing Date"] = filtered["Filing Date"].astype(str).str.strip()
-    final["Document Number"] = filtered["UBI#"].astype(str).str.strip()
+    # Address parts come out of _WA_ADDRESS already trimmed.
+    addr_df = filtered["Principal Office Address"].str.extract(_WA_ADDRESS).fillna("")
+
+    final = pd.DataFrame({
+        "Name": filtered["Business Name"].str.strip(),
+        "Address": addr_df["Address"],
+        "City": addr_df["City"],
+        "State": addr_df["State"],
+        "Zipcode": addr_df["Zipcode"],
+        "Filing Date": added_date.strip(),
+        "Document Number": filtered["UBI#"].str.strip(),
+    })
 
-    final = final.replace(r"^\s*$", pd.NA, regex=True)
-    final = final.dropna(how="any")
+    final = final[(final.notna() & final.ne("")).all(axis=1)]
 
     return final
 
@@ -608,25 +723,23 @@ def process_washington_streamlit(file, added_date: str) -> pd.DataFrame:
 # WEST VIRGINIA backend
 # =====================================================
 
+# First 5-digit run of the ZIP field. Arrow-backed str.extract only accepts
+# named groups, so the group is named even though only one is extracted.
+_WV_ZIP = r"(?P<Zipcode>\d{5})"
+
 def process_wv_streamlit(file) -> pd.DataFrame:
     """
     WV CSV → standard format:
     Name | Address | City | State | Zipcode | Filing Date | Document Number
     """
 
-    df = pd.read_csv(file)
-    df.columns = df.columns.str.strip()
-
-    df["Filing Date"] = pd.to_datetime(
-        df["Effective Date"], errors="coerce"
-    ).dt.strftime("%m/%d/%Y")
-
-    street1 = df["Street1"].fillna("").astype(str).str.strip()
-    street2 = df["Street2"].fillna("").astype(str).str.strip()
-    address = street1.where(street2 == "", street1 + ", " + street2)
-
-    zip5 = df["ZipCode"].astype(str).str.extract(r"(\d{5})", expand=False)
+    df = read_state_csv(file, [
+        "Id", "Organization Name", "Street1", "Street2", "City",
+        "StateProvince", "ZipCode", "Effective Date", "Termination Date"
+    ])
 
+    # Filter on the raw columns first so the string work below only touches
+    # rows that survive.
     mask = (
         df["Organization Name"].notna() &
         df["Street1"].notna() &
@@ -635,20 +748,38 @@ def process_wv_streamlit(file) -> pd.DataFrame:
         df["ZipCode"].notna() &
         df["Termination Date"].isna()
     )
+    df = df[mask]
+
+    street1 = df["Street1"].fillna("").str.strip()
+    street2 = df["Street2"].fillna("").str.strip()
+    # Only rows with a second street line need a new string built.
+    has2 = street2.ne("")
+    address = street1.copy()
+    address[has2] = street1[has2] + ", " + street2[has2]
+
+    # Format through pyarrow's vectorised strftime kernel rather than
+    # pandas' per-element one; unparseable dates come back null. The cast
+    # keeps the parsed unit: pandas 3 parses to "us", and forcing "ns" would
+    # overflow on sentinel dates such as 12/31/9999.
+    parsed = pd.to_datetime(df["Effective Date"], errors="coerce")
+    filing_date = (
+        parsed.astype(pd.ArrowDtype(pa.timestamp(parsed.dt.unit)))
+        .dt.strftime("%m/%d/%Y")
+    )
 
-    df_f = df[mask].copy()
-
-    final = pd.DataFrame()
-    final["Name"] = df_f["Organization Name"].astype(str).str.strip()
-    final["Address"] = address.loc[df_f.index].astype(str).str.strip()
-    final["City"] = df_f["City"].astype(str).str.strip()
-    final["State"] = df_f["StateProvince"].astype(str).str.strip()
-    final["Zipcode"] = zip5.loc[df_f.index].astype(str).str.strip()
-    final["Filing Date"] = df_f["Filing Date"].astype(str).str.strip()
-    final["Document Number"] = df_f["Id"].astype(str).str.strip()
+    # Every Series shares the filtered index, so the frame is built in its
+    # final schema with no projection, rename or reindex.
+    final = pd.DataFrame({
+        "Name": df["Organization Name"].str.strip(),
+        "Address": address,
+        "City": df["City"].str.strip(),
+        "State": df["StateProvince"].str.strip(),
+        "Zipcode": df["ZipCode"].str.extract(_WV_ZIP, expand=False),
+        "Filing Date": filing_date,
+        "Document Number": df["Id"].str.strip(),
+    })
 
-    final = final.replace(r"^\s*$", pd.NA, regex=True)
-    final = final.dropna(how="any")
+    final = final[(final.notna() & final.ne("")).all(axis=1)]
 
     return final
 
@@ -657,6 +788,42 @@ def process_wv_streamlit(file) -> pd.DataFrame:
 # Combiner page
 # =====================================================
 
+# Bounded: the cache is shared by every session for the life of the server,
+# so keep at most 32 parsed workbooks and none for longer than an hour.
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def read_xlsx(data: bytes, columns: tuple) -> pd.DataFrame:
+    """
+    Parse an uploaded workbook once; reruns with the same bytes hit the cache.
+
+    Only the named columns are kept. A callable usecols needs no separate
+    header read, and a column the sheet lacks is simply absent from the result.
+    """
+    usecols = lambda c: c in columns
+    try:
+        return pd.read_excel(BytesIO(data), engine="calamine", usecols=usecols)
+    except ImportError:
+        # python-calamine not installed: use the slower openpyxl reader.
+        return pd.read_excel(BytesIO(data), engine="openpyxl", usecols=usecols)
+
+
+def as_shared_category(frames: list, col: str) -> list:
+    """
+    Recode `col` in every frame to one CategoricalDtype built from the union of
+    their values. concat keeps a categorical only when all inputs share the same
+    categories, and then just stitches the small integer codes together.
+    """
+    categories = set()
+    for df in frames:
+        categories.update(df[col].dropna().unique())
+
+    rows = sum(len(df) for df in frames)
+    if len(categories) * 2 > rows:
+        return frames  # mostly unique values; codes would not save anything
+
+    dtype = pd.CategoricalDtype(sorted(categories, key=str))
+    return [df.astype({col: dtype}) for df in frames]
+
+
 def combiner_page():
     st.header("🔗 Combine Files")
 
@@ -678,10 +845,13 @@ def combiner_page():
     selections = {}
     valid_files = []
 
-    for i, file in enumerate(uploaded_files):
+    # Parse all uploads up front on a small pool so workbooks decode side by
+    # side; the previews and the combine below reuse these frames.
+    with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as pool:
+        frames = list(pool.map(lambda f: read_xlsx(f.getvalue(), tuple(required_cols)), uploaded_files))
+
+    for i, (file, df_preview) in enumerate(zip(uploaded_files, frames)):
         with st.expander(f"{file.name}"):
-            file.seek(0)
-            df_preview = pd.read_excel(file, engine="openpyxl")
             missing = [c for c in required_cols if c not in df_preview.columns]
 
             if missing:
@@ -694,17 +864,26 @@ def combiner_page():
                     value="ALL",
                     key=key
                 )
+                if _parse_choice(selections[file.name]) is None:
+                    st.warning("⚠️ Selection not recognised — ALL rows of this file will be used.")
                 valid_files.append(file.name)
 
+    # Outside the button block so the choice survives the rerun it triggers.
+    # Large combines default to csv, which skips xlsx's XML serialisation.
+    total_rows = sum(len(df) for file, df in zip(uploaded_files, frames) if file.name in valid_files)
+    fmt = st.radio(
+        "Output format", ["xlsx", "parquet", "csv"], horizontal=True,
+        index=2 if total_rows > 100_000 else 0,
+        help="xlsx opens in Excel; parquet and csv are much faster for large outputs."
+    )
+
     if st.button("🔗 Combine Selected Rows"):
         all_frames = []
 
-        for file in uploaded_files:
+        for file, df in zip(uploaded_files, frames):
             if file.name not in valid_files:
                 continue
 
-            file.seek(0)
-            df = pd.read_excel(file, engine="openpyxl")
             choice = selections.get(file.name, "ALL")
             df_sel = select_rows(df, choice)
             all_frames.append(df_sel)
@@ -713,16 +892,38 @@ def combiner_page():
             st.error("❌ No valid data to combine (all files had missing columns).")
             return
 
+        for col in ("State", "City"):
+            all_frames = as_shared_category(all_frames, col)
+
         combined = pd.concat(all_frames, ignore_index=True)
         st.success(f"✅ Combined rows: {len(combined):,}")
 
-        out = BytesIO()
-        combined.to_excel(out, index=False)
+        if fmt == "parquet":
+            # Files can disagree on a column's type (e.g. numeric vs text IDs);
+            # parquet needs one type per column, so mixed columns become text.
+            # Only true object columns: on pandas 3 select_dtypes("object") also
+            # picks the str columns (with a Pandas4Warning) for no reason.
+            mixed = [c for c, t in combined.dtypes.items() if t == object]
+            data = combined.astype({c: "string" for c in mixed}).to_parquet(
+                engine="pyarrow", compression="zstd", index=False
+            )
+            label, mime = "Parquet", "application/vnd.apache.parquet"
+        elif fmt == "csv":
+            data = combined.to_csv(index=False).encode("utf-8")
+            label, mime = "CSV", "text/csv"
+        else:
+            try:
+                data = to_xlsx_bytes(combined)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+                return
+            label, mime = "Excel", XLSX_MIME
+
         st.download_button(
-            "⬇️ Download Combined Excel",
-            data=out.getvalue(),
-            file_name="Combined_States.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            f"⬇️ Download Combined {label}",
+            data=data,
+            file_name=f"Combined_States.{fmt}",
+            mime=mime
         )
 
 
@@ -730,6 +931,28 @@ def combiner_page():
 # State processing page
 # =====================================================
 
+def xlsx_download_button(df: pd.DataFrame, label: str, file_stem: str):
+    """Excel download for a processed frame, or CSV when it is too big for a sheet."""
+    try:
+        data = to_xlsx_bytes(df)
+    except ValueError as e:
+        st.error(f"❌ {e}")
+        st.download_button(
+            f"⬇️ Download {label} CSV",
+            data=df.to_csv(index=False).encode("utf-8"),
+            file_name=f"{file_stem}.csv",
+            mime="text/csv"
+        )
+        return
+
+    st.download_button(
+        f"⬇️ Download {label} Excel",
+        data=data,
+        file_name=f"{file_stem}.xlsx",
+        mime=XLSX_MIME
+    )
+
+
 def state_page():
     st.header("🏛 Process Individual State Files")
 
@@ -745,14 +968,7 @@ def state_page():
             st.success(f"Rows after processing: {len(df):,}")
             st.dataframe(df.head())
 
-            out = BytesIO()
-            df.to_excel(out, index=False)
-            st.download_button(
-                "⬇️ Download Florida Excel",
-                data=out.getvalue(),
-                file_name="Florida_Output.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+            xlsx_download_button(df, "Florida", "Florida_Output")
 
     elif state == "Washington":
         uploaded = st.file_uploader("Upload Washington CSV file", type=["csv"])
@@ -763,14 +979,7 @@ def state_page():
             st.success(f"Rows after processing: {len(df):,}")
             st.dataframe(df.head())
 
-            out = BytesIO()
-            df.to_excel(out, index=False)
-            st.download_button(
-                "⬇️ Download Washington Excel",
-                data=out.getvalue(),
-                file_name="Washington_Clean.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+            xlsx_download_button(df, "Washington", "Washington_Clean")
 
     else:  # West Virginia
         uploaded = st.file_uploader("Upload West Virginia CSV file", type=["csv"])
@@ -780,14 +989,7 @@ def state_page():
             st.success(f"Rows after processing: {len(df):,}")
             st.dataframe(df.head())
 
-            out = BytesIO()
-            df.to_excel(out, index=False)
-            st.download_button(
-                "⬇️ Download WV Excel",
-                data=out.getvalue(),
-                file_name="WV_Output.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+            xlsx_download_button(df, "WV", "WV_Output")
 
 
 # =====================================================
@@ -811,14 +1013,10 @@ if not st.session_state["auth"]:
 # Logged-in view
 st.sidebar.markdown(f"**Logged in as:** {st.session_state['user']}")
 
-# Theme toggle
-theme_choice = st.sidebar.radio(
-    "Theme",
-    ["Light", "Dark"],
-    index=0 if st.session_state["theme"] == "Light" else 1,
-)
-st.session_state["theme"] = theme_choice  # update theme
-apply_theme()  # re-apply in case user toggled
+# Theme toggle: keyed to session state, so a toggle is already in
+# st.session_state["theme"] when the rerun starts and the apply_theme()
+# call at the top emits the right CSS once per run.
+st.sidebar.radio("Theme", ["Light", "Dark"], key="theme")
 
 if st.sidebar.button("Logout"):
     logout()